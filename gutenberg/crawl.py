@@ -1,175 +1,341 @@
-import aiohttp
+import httpx
 import asyncio
-from bs4 import BeautifulSoup
-import pandas as pd
+import aiofiles
+from selectolax.lexbor import LexborHTMLParser
 from tqdm.asyncio import tqdm
 import re
 import os
 import logging
-import csv
-from aiohttp import ClientTimeout, ClientError
+import orjson
+import tarfile
+import time
+from email.utils import parsedate_to_datetime
+from lxml import etree
+from tenacity import retry, retry_if_exception_type, stop_after_attempt
 
 # Set up logging
 logging.basicConfig(filename='download_books.log', level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+# httpx logs every request at INFO level, which would flood the log on a full crawl
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 # Define User-Agent header for HTTP requests
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
 }
 
+# JSON Lines metadata file with one record per downloaded book, and the directory holding the book texts
+OUTPUT_FILE = 'gutenberg_books.jsonl'
+TEXTS_DIR = 'texts'
+
+# Characters that are not allowed in generated file names
+_BAD = re.compile(r'[^\w .,]+')
+
+# Cap the number of requests in flight across all downloads
+semaphore = asyncio.Semaphore(64)
+
+# Status codes that are worth retrying; anything else fails straight away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Longest we are willing to wait between two attempts, whatever the server asks for
+MAX_RETRY_DELAY = 60
+
+# Bulk RDF catalog holding the metadata of every book on Gutenberg
+CATALOG_URL = "https://www.gutenberg.org/cache/epub/feeds/rdf-files.tar.bz2"
+CATALOG_FILE = 'rdf-files.tar.bz2'
+
+# Book file extensions to download, in order of preference
+PREFERRED_EXTENSIONS = ["txt.utf8", "txt", "html"]
+
+# Four-digit year in release dates
+_YEAR_RE = re.compile(r'\d{4}')
+
+# XML namespaces used by the Gutenberg RDF files
+RDF_NS = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'pgterms': 'http://www.gutenberg.org/2009/pgterms/',
+}
+
+# Work out how long to wait before retrying, honouring the server's rate limit headers
+def retry_delay(response, attempt):
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            if retry_after.isdigit():
+                return int(retry_after)
+            try:
+                return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+        reset = response.headers.get('X-RateLimit-Reset')
+        if response.headers.get('X-RateLimit-Remaining') == '0' and reset and reset.isdigit():
+            # The reset value is either an epoch timestamp or a number of seconds
+            reset = int(reset)
+            return max(0, reset - time.time()) if reset > time.time() else reset
+    return 2 ** attempt  # Exponential backoff
+
+# Raised for responses whose status code is worth retrying
+class RetryableStatusError(Exception):
+    def __init__(self, response):
+        super().__init__(f"Status code {response.status_code}")
+        self.response = response
+
+# Failures that may go away on a retry; other errors such as an invalid URL will not
+RETRY_EXCEPTIONS = (RetryableStatusError, httpx.TimeoutException, httpx.NetworkError, httpx.ProtocolError)
+
+# Tenacity wait strategy: use the server's rate limit headers when a response carried them
+def wait_for_server(retry_state):
+    error = retry_state.outcome.exception()
+    response = error.response if isinstance(error, RetryableStatusError) else None
+    return min(retry_delay(response, retry_state.attempt_number - 1), MAX_RETRY_DELAY)
+
 # Asynchronously fetch text content from a URL with retries and timeout handling
+@retry(stop=stop_after_attempt(3), wait=wait_for_server, retry=retry_if_exception_type(RETRY_EXCEPTIONS),
+       retry_error_callback=lambda retry_state: None)
 async def fetch_text(session, url):
-    retries = 3
-    timeout = ClientTimeout(total=60)  # Set a total request timeout of 60 seconds
-    for attempt in range(retries):
-        try:
-            async with session.get(url, timeout=timeout) as response:
-                if response.status == 200:
-                    try:
-                        return await response.text()
-                    except UnicodeDecodeError:
-                        # Attempt alternative encoding if UTF-8 decode fails
-                        raw_text = await response.read()
-                        return raw_text.decode('ISO-8859-1')
-                else:
-                    logging.error(f"Failed to fetch {url}: Status code {response.status}")
-                    continue  # Proceed to the next attempt
-        except asyncio.TimeoutError:
-            logging.warning(f"Timeout occurred when fetching {url}")
-        except Exception as e:
-            logging.error(f"Error fetching {url}: {str(e)}")
-        if attempt < retries - 1:
-            await asyncio.sleep(2 ** attempt)  # Exponential backoff
-    return None
+    try:
+        async with semaphore:
+            response = await session.get(url)
+    except httpx.TimeoutException:
+        logging.warning(f"Timeout occurred when fetching {url}")
+        raise
+    except RETRY_EXCEPTIONS as e:
+        logging.error(f"Error fetching {url}: {str(e)}")
+        raise
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        logging.error(f"Error fetching {url}: {str(e)}")
+        return None
+    if response.status_code != 200:
+        logging.error(f"Failed to fetch {url}: Status code {response.status_code}")
+        if response.status_code in RETRY_STATUSES:
+            raise RetryableStatusError(response)
+        return None  # Other errors such as 404 will not go away on a retry
+    raw_text = response.content
+    try:
+        return raw_text.decode('utf-8')
+    except UnicodeDecodeError:
+        # Attempt alternative encoding if UTF-8 decode fails
+        return raw_text.decode('ISO-8859-1', errors='replace')
 
-# Attempt to download book data from various file types and versions
+# Look up the files available for a book and download the preferred text version
 async def get_book_data(session, book_id):
     base_url = f"https://www.gutenberg.org/files/{book_id}"
-    # List of possible file extensions and versions to try
-    extensions = ["epub", "html", "pdf", "txt", "txt.utf8"]
-    for i in range(10):  # Assume: Check versions from 0 to 9
-        for ext in extensions:
-            url = f"{base_url}/{book_id}-{i}.{ext}"
-            if ext in ["epub", "html"]:  # For EPUB and HTML, also check "no images" variants
-                url_no_images = f"{base_url}/{book_id}-{i}.{ext}.noimages"
-                text = await fetch_text(session, url_no_images)
-                if text:
-                    logging.info(f"Found valid text at {url_no_images}")
-                    return text
+    # A single request for the directory listing tells us which files actually exist
+    listing = await fetch_text(session, f"{base_url}/")
+    if not listing:
+        logging.warning(f"Book ID {book_id}: No file listing available.")
+        return None
+    file_names = {link.attributes.get('href', '').split('/')[-1] for link in LexborHTMLParser(listing).css('a')}
+    for ext in PREFERRED_EXTENSIONS:
+        # Check versions from 0 to 9 before the file without a version number
+        candidates = [f"{book_id}-{i}.{ext}" for i in range(10)] + [f"{book_id}.{ext}"]
+        for file_name in candidates:
+            if file_name not in file_names:
+                continue
+            url = f"{base_url}/{file_name}"
             text = await fetch_text(session, url)
             if text:
                 logging.info(f"Found valid text at {url}")
                 return text
-            else:
-                logging.info(f"No valid text at {url}")
-    
-    # Also check for files without version numbers
-    for ext in extensions:
-        url = f"{base_url}/{book_id}.{ext}"
-        if ext in ["epub", "html"]:  # For EPUB and HTML, also check "no images" variants
-            url_no_images = f"{base_url}/{book_id}.{ext}.noimages"
-            text = await fetch_text(session, url_no_images)
-            if text:
-                logging.info(f"Found valid text at {url_no_images}")
-                return text
-        text = await fetch_text(session, url)
-        if text:
-            logging.info(f"Found valid text at {url}")
-            return text
-        else:
             logging.info(f"No valid text at {url}")
 
-    logging.warning(f"Book ID {book_id}: All URL patterns failed.")
+    logging.warning(f"Book ID {book_id}: No text file found in {base_url}/")
     return None
 
+# Download the bulk RDF catalog once, keeping it on disk for later runs
+async def download_catalog(session):
+    if os.path.exists(CATALOG_FILE):
+        return True
+    partial_file = CATALOG_FILE + '.part'
+    try:
+        # The client timeout bounds each read rather than the whole transfer, which suits this large archive
+        async with session.stream('GET', CATALOG_URL) as response:
+            if response.status_code != 200:
+                logging.error(f"Failed to fetch {CATALOG_URL}: Status code {response.status_code}")
+                return False
+            with open(partial_file, 'wb') as file:
+                async for chunk in response.aiter_bytes(1 << 16):
+                    file.write(chunk)
+    except httpx.HTTPError as e:
+        logging.error(f"Error fetching {CATALOG_URL}: {str(e)}")
+        return False
+    except OSError as e:
+        # E.g. a full disk; books fall back to having their page scraped
+        logging.error(f"Failed to save {partial_file}: {str(e)}")
+        return False
+    os.replace(partial_file, CATALOG_FILE)
+    return True
+
+# Build a {book_id: metadata} lookup from the RDF catalog archive
+def parse_catalog(path):
+    catalog = {}
+    with tarfile.open(path, 'r|bz2') as archive:
+        for member in archive:
+            if not member.name.endswith('.rdf'):
+                continue
+            rdf_file = archive.extractfile(member)
+            if rdf_file is None:
+                continue
+            try:
+                for _, ebook in etree.iterparse(rdf_file, tag=f"{{{RDF_NS['pgterms']}}}ebook"):
+                    book_id = ebook.get(f"{{{RDF_NS['rdf']}}}about", '').split('/')[-1]
+                    issued = ebook.findtext('dcterms:issued', default='', namespaces=RDF_NS)
+                    language = ebook.findtext('dcterms:language/rdf:Description/rdf:value', default='', namespaces=RDF_NS)
+                    year_match = _YEAR_RE.search(issued)
+                    catalog[book_id] = {
+                        'year': year_match.group(0) if year_match else "Unknown",
+                        'language': language or "Unknown"
+                    }
+                    ebook.clear()
+            except etree.XMLSyntaxError as e:
+                # Books from a malformed file fall back to having their page scraped
+                logging.warning(f"Skipping malformed catalog entry {member.name}: {str(e)}")
+    return catalog
+
 # Fetch metadata such as year and language for a given book ID
 async def get_book_metadata(session, book_id):
     url = f"https://www.gutenberg.org/ebooks/{book_id}"
     metadata = {'year': "Unknown", 'language': "Unknown"}
     text = await fetch_text(session, url)
     if text:
-        soup = BeautifulSoup(text, 'html.parser')
-        metadata_table = soup.find('table', class_='bibrec')
+        tree = LexborHTMLParser(text)
+        metadata_table = tree.css_first('table.bibrec')
         if metadata_table:
-            for row in metadata_table.find_all('tr'):
-                th_text = row.find('th').get_text() if row.find('th') else ''
-                td_text = row.find('td').get_text() if row.find('td') else ''
+            for row in metadata_table.css('tr'):
+                th = row.css_first('th')
+                td = row.css_first('td')
+                th_text = th.text() if th else ''
+                td_text = td.text() if td else ''
                 if 'Release Date' in th_text:
-                    year_match = re.search(r'\d{4}', td_text)
+                    year_match = _YEAR_RE.search(td_text)
                     if year_match:
                         metadata['year'] = year_match.group(0)
                 if 'Language' in th_text:
                     metadata['language'] = td_text.strip()
     return metadata
 
-# Download and save book data including text and metadata
-async def download_books(session, book, progress):
-    book_id = book.a['href'].split('/')[-1]
-    metadata = await get_book_metadata(session, book_id)
-    if metadata['language'].lower() != 'english':
+# Download a book, save its text to a file and return its metadata
+async def download_books(session, catalog, book_id, title, author, progress):
+    metadata = catalog.get(book_id)
+    if metadata is None:
+        # Books newer than the catalog snapshot still need their page scraped
+        metadata = await get_book_metadata(session, book_id)
+    # The catalog stores language codes, the book pages full language names
+    if metadata['language'].lower() not in ('en', 'english'):
         progress.update(1)
         return None
-    title = book.select_one('span.title').text if book.select_one('span.title') else "No Title"
-    author = book.select_one('span.subtitle').text if book.select_one('span.subtitle') else "Unknown Author"
     text = await get_book_data(session, book_id)
     progress.update(1)
     if text:
+        # Generate file name by removing special characters and limiting the length
+        file_path = os.path.join(TEXTS_DIR, f"{book_id}_{_BAD.sub('', title)[:50]}.txt")
+        try:
+            async with aiofiles.open(file_path, 'w', encoding='utf-8') as file:
+                await file.write(clean_text(text))
+        except OSError as e:
+            logging.error(f"Failed to save {file_path}: {e}")
+            return None
         return {
             'ID': book_id,
             'Title': title,
             'Author': author,
-            'Year': metadata['year'],
-            'Text': text
+            'Year': metadata['year']
         }
 
-# Retrieve a list of books from Gutenberg's search results
-async def get_books_list():
+# Retrieve books from Gutenberg's search results, writing each one out as soon as it is downloaded.
+# Returns False if a results page could not be fetched, leaving the crawl incomplete.
+async def get_books_list(output, processed_books):
     index_url = "https://www.gutenberg.org/ebooks/search/?sort_order=downloads&languages=en"
-    books = []
-    processed_books = set()  # Set to keep track of processed book IDs
-    async with aiohttp.ClientSession(headers=headers) as session:
+    # HTTP/2 multiplexes all concurrent requests to gutenberg.org over a shared connection
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=64)
+    async with httpx.AsyncClient(http2=True, headers=headers, limits=limits, timeout=60.0, follow_redirects=True) as session:
+        catalog = {}
+        if await download_catalog(session):
+            try:
+                catalog = await asyncio.to_thread(parse_catalog, CATALOG_FILE)
+            except (tarfile.TarError, EOFError, OSError) as e:
+                # Drop the damaged archive so the next run downloads a fresh copy
+                logging.error(f"Failed to read {CATALOG_FILE}, falling back to book pages: {str(e)}")
+                os.remove(CATALOG_FILE)
+        text = await fetch_text(session, index_url)
         while True:
-            text = await fetch_text(session, index_url)
-            if text:
-                soup = BeautifulSoup(text, 'html.parser')
-                book_elements = soup.select('li.booklink')
-                if not book_elements:
-                    break
-                progress = tqdm(total=len(book_elements), desc="Downloading books")
-                tasks = []
-                for book in book_elements:
-                    book_id = book.a['href'].split('/')[-1]
-                    if book_id not in processed_books:
-                        tasks.append(download_books(session, book, progress))
-                        processed_books.add(book_id)
-                results = await asyncio.gather(*tasks)
-                books.extend([result for result in results if result])
-                progress.close()
-                next_button = soup.find('a', string='Next')
-                if next_button:
-                    index_url = "https://www.gutenberg.org" + next_button['href']
-                else:
-                    break
-    return books
+            if text is None:
+                logging.error(f"Failed to fetch results page {index_url}, stopping the crawl")
+                return False
+            tree = LexborHTMLParser(text)
+            book_elements = tree.css('li.booklink')
+            if not book_elements:
+                return True
+            # Start fetching the next results page while this page's books download
+            next_button = next((a for a in tree.css('a') if a.text() == 'Next'), None)
+            next_page = None
+            if next_button:
+                index_url = "https://www.gutenberg.org" + next_button.attributes['href']
+                next_page = asyncio.create_task(fetch_text(session, index_url))
+            progress = tqdm(total=len(book_elements), desc="Downloading books")
+            tasks = []
+            for book in book_elements:
+                book_id = book.css_first('a').attributes['href'].split('/')[-1]
+                if book_id not in processed_books:
+                    title_node = book.css_first('span.title')
+                    author_node = book.css_first('span.subtitle')
+                    title = title_node.text() if title_node else "No Title"
+                    author = author_node.text() if author_node else "Unknown Author"
+                    tasks.append(download_books(session, catalog, book_id, title, author, progress))
+                    processed_books.add(book_id)
+            for task in asyncio.as_completed(tasks):
+                book = await task
+                if book:
+                    output.write(orjson.dumps(book) + b'\n')
+            progress.close()
+            if next_page is None:
+                return True
+            text = await next_page
+
+# Any character outside ASCII becomes a space
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7F]')
+
+# Control characters are dropped and whitespace breaks become spaces; printable ASCII is kept
+_TRANS = {i: None for i in range(0x00, 0x20)}
+_TRANS.update({0x7F: None})
+_TRANS.update({0x09: 0x20, 0x0A: 0x20, 0x0D: 0x20})
 
 # Clean the text to remove or replace characters that may cause issues
 def clean_text(text):
     """Remove or replace illegal characters that might cause issues."""
-    text = re.sub(r'[^\x00-\x7F]+', ' ', text)
-    text = re.sub(r'[\x00-\x1F\x7F-\x9F]+', '', text)
-    text = text.replace('\r', ' ').replace('\n', ' ').replace('\t', ' ')
-    return text
+    if not text.isascii():
+        text = _NON_ASCII_RE.sub(' ', text)
+    # The text is ASCII at this point, so translate stays on its fast path
+    return text.translate(_TRANS)
 
-# Save the books data to a TSV file
-def save_to_csv(books):
-    df = pd.DataFrame(books)
-    df['Text'] = df['Text'].apply(clean_text)
-    df.to_csv('gutenberg_books.tsv', sep='\t', index=False, encoding='utf-8', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+# Collect the IDs of books saved by an earlier, interrupted run so they are not downloaded again
+def load_processed_books(path):
+    processed_books = set()  # Set to keep track of processed book IDs
+    if not os.path.exists(path):
+        return processed_books
+    with open(path, 'r+b') as file:
+        saved_size = 0
+        for line in file:
+            if not line.endswith(b'\n'):
+                break  # A record cut off mid-write is dropped and its book fetched again
+            processed_books.add(orjson.loads(line)['ID'])
+            saved_size += len(line)
+        file.truncate(saved_size)
+    return processed_books
 
 # Main entry point for the script
 if __name__ == "__main__":
-    if not os.path.exists('gutenberg_books.tsv'):
-        books = asyncio.run(get_books_list())
-        save_to_csv(books)
+    if not os.path.exists(OUTPUT_FILE):
+        os.makedirs(TEXTS_DIR, exist_ok=True)
+        # Write to a partial file so an interrupted run is not mistaken for a finished one,
+        # and resume from it if an earlier run stopped early
+        partial_file = OUTPUT_FILE + '.part'
+        processed_books = load_processed_books(partial_file)
+        with open(partial_file, 'ab') as file:
+            completed = asyncio.run(get_books_list(file, processed_books))
+        if completed:
+            os.replace(partial_file, OUTPUT_FILE)
+        else:
+            print(f"Crawl stopped early, run again to resume from {partial_file}.")
     else:
         print("Data already downloaded.")
\ No newline at end of file